@@ -1,16 +1,64 @@
 import argparse
+import functools
 import logging
+import os
+import queue
 import re
+import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Union
 
-import whisper
+import numpy as np
 from clams import ClamsApp, Restifier
 from lapps.discriminators import Uri
 from mmif import Mmif, View, AnnotationTypes, DocumentTypes
 
 import metadata as app_metadata
 
+_CAMEL_CASE_BOUNDARY = re.compile(r'(?<!^)(?=[A-Z])')
+# how many copies of the same model can be loaded, i.e., how many requests can use the same model concurrently
+_NUM_WORKERS = int(os.environ.get('WHISPER_NUM_WORKERS', 1))
+if _NUM_WORKERS < 1:
+    raise ValueError(f'WHISPER_NUM_WORKERS must be a positive integer, got {_NUM_WORKERS}')
+# whether to compile the model encoder with `torch.compile` (takes extra time when a model is loaded)
+_TORCH_COMPILE = os.environ.get('WHISPER_TORCH_COMPILE', '').lower() in ('1', 'true', 'yes')
+# idle loaded models and the semaphores guarding them are shared by all app instances in the process
+_WHISPER_MODELS = {}
+_MODEL_SEMAPHORES = {}
+_VAD_LOCK = threading.Lock()
+# speech regions detected by VAD are merged into clips up to this length, i.e., whisper's input window size
+_MAX_CLIP_SECONDS = 30
+
+
+def _load_audio(path):
+    from whisper.audio import SAMPLE_RATE
+    # same as `whisper.load_audio`, but ffmpeg directly outputs float32 samples, instead of int16 samples that
+    # then need to be converted and normalized (with two more full-length array allocations)
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-i", path,
+           "-f", "f32le", "-ac", "1", "-acodec", "pcm_f32le", "-ar", str(SAMPLE_RATE), "-"]
+    # stderr goes to a file, so that a chatty ffmpeg can't fill up the pipe while we're reading stdout
+    with tempfile.TemporaryFile() as stderr, subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr) as proc:
+        # read samples straight into a writable buffer, as a read-only `bytes` buffer would need another
+        # full-length copy to be writable (whisper passes the array to `torch.from_numpy`, which warns otherwise)
+        samples = bytearray()
+        for chunk in iter(functools.partial(proc.stdout.read, 1 << 20), b''):
+            samples += chunk
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+    return np.frombuffer(samples, np.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_vad():
+    # silero VAD model, bundled with the `silero-vad` package (no download needed)
+    from silero_vad import load_silero_vad
+    return load_silero_vad()
+
 
 class WhisperWrapper(ClamsApp):
     
@@ -27,8 +75,12 @@ class WhisperWrapper(ClamsApp):
 
     def __init__(self):
         super().__init__()
-        self.whisper_models = {}
-        self.model_usage = {}
+        self.whisper_models = _WHISPER_MODELS
+        self.model_semaphores = _MODEL_SEMAPHORES
+        # app parameters delegated to whisper, mapped to the (snake_case) argument names of whisper's transcribe
+        self.whisper_param_map = {param.name: _CAMEL_CASE_BOUNDARY.sub('_', param.name).lower()
+                                  for param in self.metadata.parameters
+                                  if param.description.startswith(app_metadata.whisper_argument_delegation_prefix)}
 
     def _appmetadata(self):
         pass
@@ -56,48 +108,65 @@ class WhisperWrapper(ClamsApp):
                            "length_penalty": None,
                            "suppress_tokens": "-1",
                            }
-        for param in self.metadata.parameters:
-            if param.description.startswith(app_metadata.whisper_argument_delegation_prefix):
-                pattern = re.compile(r'(?<!^)(?=[A-Z])')
-                transcribe_args[pattern.sub('_', param.name).lower()] = parameters[param.name]
+        for name, snake_name in self.whisper_param_map.items():
+            transcribe_args[snake_name] = parameters[name]
         # this is due to the limitation of the SDK that doesn't allow `None` for a default value for a parameter
         # (setting default to None is a reserved action to make the parameter optional)
         # So as a workaround, the default is set to an empty string, then to match the behavior of the whisper cli,
         # it's converted to None here.
         if transcribe_args['initial_prompt'] == '':
             transcribe_args['initial_prompt'] = None
-        if size not in self.whisper_models:
-            self.logger.debug(f'Loading model {size}')
-            t = time.perf_counter()
-            self.whisper_models[size] = whisper.load_model(size)
-            self.logger.debug(f'Load time: {time.perf_counter() - t:.2f} seconds\n')
-            self.model_usage[size] = False
-        if not self.model_usage[size]:
-            whisper_model = self.whisper_models.get(size)
-            self.model_usage[size] = True
-            cached = True
-        else:
-            self.logger.debug(f'Loading model {size} to avoid memory conflict')
-            t = time.perf_counter()
-            whisper_model = whisper.load_model(size)
-            self.logger.debug(f'Load time: {time.perf_counter() - t:.2f} seconds\n')
-            cached = False
-
-        for doc in docs:
-            transcribe_args['language'] = lang if len(lang) > 0 else None
-            transcribe_args['word_timestamps'] = True
-            self.logger.debug(f'whisper model args: {transcribe_args}')
-            self.logger.debug('Transcribing audio')
-            t = time.perf_counter()
-            transcript = whisper_model.transcribe(audio=doc.location_path(nonexist_ok=False), 
-                                                  **transcribe_args)
-            self.logger.debug(f'Transcription time: {time.perf_counter() - t:.2f} seconds\n')
+        if parameters['throughputMode']:
+            # greedy decoding without temperature fallback, and no prompting with the previous window
+            transcribe_args.update(beam_size=None, best_of=None, temperature=0.0, condition_on_previous_text=False)
+        transcribe_args['language'] = lang if len(lang) > 0 else None
+        transcribe_args['word_timestamps'] = True
+        compute_type = parameters['computeType']
+        if compute_type == 'auto':
+            compute_type = self._default_compute_type()
+        elif compute_type == 'int8' and not self._has_quantized_engine():
+            raise ValueError('computeType=int8 is not available, as this torch installation has no quantized kernel '
+                             'backend; use float32 instead')
+        transcribe_args['fp16'] = compute_type == 'float16'
+        self.logger.debug(f'whisper model args: {transcribe_args}')
+
+        paths = [doc.location_path(nonexist_ok=False) for doc in docs]
+        transcripts = []
+
+        def prepare_audio(path):
+            audio = _load_audio(path)
+            return audio, (self._speech_clips(audio) if parameters['vadFilter'] else None)
+
+        # audio is decoded with an ffmpeg subprocess (and then optionally run through VAD), so the next document
+        # is prepared in a background thread while the current one is transcribed. Only one document is prepared
+        # ahead, to bound the memory held by decoded audio and not to compete with transcription for CPU cores
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_audio = executor.submit(prepare_audio, paths[0]) if paths else None
+            with self._checkout_model(size, compute_type) as whisper_model:
+                for i in range(len(paths)):
+                    audio, speech_clips = next_audio.result()
+                    if i + 1 < len(paths):
+                        next_audio = executor.submit(prepare_audio, paths[i + 1])
+                    doc_transcribe_args = transcribe_args
+                    if speech_clips:
+                        # whisper only decodes the given clips, and timestamps are still relative to the whole audio
+                        doc_transcribe_args = dict(transcribe_args, clip_timestamps=speech_clips)
+                    elif speech_clips is not None:
+                        # whisper would take an empty clip list as the whole audio anyway
+                        self.logger.debug('No speech detected by VAD, transcribing the whole audio')
+                    self.logger.debug('Transcribing audio')
+                    t = time.perf_counter()
+                    transcripts.append(whisper_model.transcribe(audio=audio, **doc_transcribe_args))
+                    self.logger.debug(f'Transcription time: {time.perf_counter() - t:.2f} seconds\n')
+
+        for doc, transcript in zip(docs, transcripts):
             # keep the original language parameter, that might have region code as well
             self.logger.debug(f'Preparing a new transcript view for {doc.id}')
             t = time.perf_counter()
             lang_to_record = parameters['modelLang'] if len(parameters['modelLang']) > 0 else transcript['language']
             view: View = mmif.new_view()
-            self.sign_view(view, parameters)
+            # record the compute type actually used, as `auto` resolves differently depending on the hardware
+            self.sign_view(view, dict(parameters, computeType=compute_type))
             view.new_contain(DocumentTypes.TextDocument, _lang=lang_to_record)
             view.new_contain(Uri.TOKEN)
             view.new_contain(AnnotationTypes.TimeFrame, timeUnit=app_metadata.timeunit, document=doc.id)
@@ -107,35 +176,150 @@ class WhisperWrapper(ClamsApp):
             t = time.perf_counter()
             self._whisper_to_textdocument(transcript, view, mmif.get_document_by_id(doc.id), lang=lang_to_record)
             self.logger.debug(f'Translation time: {time.perf_counter() - t:.2f} seconds\n')
-        
-        if size in self.model_usage and cached == True:
-                self.model_usage[size] = False
         return mmif
 
+    @contextmanager
+    def _checkout_model(self, size, compute_type):
+        # a whisper model can't be shared by concurrent transcriptions (decoding installs kv-cache hooks on the
+        # model modules), so each request takes an idle copy of the model for itself. Up to `_NUM_WORKERS` copies
+        # are loaded on demand, and further concurrent requests wait for one to be returned, instead of loading
+        # yet another copy of the weights
+        import torch
+        # int8 dynamic quantization kernels are only available on CPU. Other compute types share the same (fp32)
+        # weights, as the decoding precision is chosen per transcription, so they share the loaded copies as well
+        quantized = compute_type == 'int8'
+        device = 'cuda' if torch.cuda.is_available() and not quantized else 'cpu'
+        model_key = (size, device, quantized)
+        idle_models = self.whisper_models.setdefault(model_key, queue.SimpleQueue())
+        with self.model_semaphores.setdefault(model_key, threading.BoundedSemaphore(_NUM_WORKERS)):
+            try:
+                whisper_model = idle_models.get_nowait()
+            except queue.Empty:
+                # all loaded copies (if any) are in use, but the semaphore guarantees there are less than the limit
+                whisper_model = self._load_model(size, device, quantized)
+            try:
+                yield whisper_model
+            finally:
+                idle_models.put(whisper_model)
+
+    @staticmethod
+    def _speech_clips(audio):
+        import torch
+        from silero_vad import get_speech_timestamps
+        from whisper.audio import SAMPLE_RATE
+        # the VAD model keeps internal states while processing an audio, hence can't be used concurrently
+        with _VAD_LOCK:
+            speech = get_speech_timestamps(torch.from_numpy(audio), _load_vad(), sampling_rate=SAMPLE_RATE)
+        # VAD splits speech at every short pause, but whisper processes each clip in at least one full (padded)
+        # 30-second window, so neighboring regions are merged into clips that fill up a window (as long as they fit)
+        clips = []
+        for region in speech:
+            if clips and region['end'] - clips[-1][0] <= _MAX_CLIP_SECONDS * SAMPLE_RATE:
+                clips[-1][1] = region['end']
+            else:
+                clips.append([region['start'], region['end']])
+        # flat list of start, end, start, end, ... (in seconds), as whisper's `clip_timestamps` takes
+        return [sample / SAMPLE_RATE for clip in clips for sample in clip]
+
+    @staticmethod
+    def _default_compute_type():
+        import torch
+        if torch.cuda.is_available():
+            # on GPU, whisper already decodes in fp16
+            return 'float16'
+        # on CPU, we use int8 dynamic quantization, but only if this torch build ships a quantized kernel backend
+        if WhisperWrapper._has_quantized_engine():
+            return 'int8'
+        return 'float32'
+
+    @staticmethod
+    def _has_quantized_engine():
+        import torch
+        return any(engine != 'none' for engine in torch.backends.quantized.supported_engines)
+
+    def _load_model(self, size, device, quantized):
+        import torch
+        import whisper
+        # log the actual device, so that a silent fallback to CPU can be noticed
+        self.logger.debug(f'Loading model {size} ({"int8" if quantized else "float32"}) on '
+                          f'{torch.cuda.get_device_name() if device == "cuda" else device}')
+        t = time.perf_counter()
+        model = whisper.load_model(size, device=device)
+        if quantized:
+            # whisper uses its own `Linear` subclass (that only casts weights to the input dtype), which
+            # `quantize_dynamic` doesn't recognize, hence first turn them into plain torch `Linear` layers
+            for module in model.modules():
+                if isinstance(module, whisper.model.Linear):
+                    module.__class__ = torch.nn.Linear
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif _TORCH_COMPILE and hasattr(torch, 'compile'):
+            # the encoder always takes fixed-size (30 seconds) mel windows, so it compiles into a single graph. The
+            # decoder is left as is, as its kv-cache hooks and ever-growing inputs would keep triggering recompilation
+            model.encoder = torch.compile(model.encoder)
+            # warm up, to pay the compilation cost at load time, not in the first transcription. Each input dtype
+            # whisper can decode in on the device (fp16 only on GPU) compiles into a separate graph, and so does the
+            # encoder without SDPA, as word timestamp alignment runs the model with SDPA disabled
+            dtypes = (torch.float16, torch.float32) if model.device.type == 'cuda' else (torch.float32,)
+            with torch.no_grad():
+                for dtype in dtypes:
+                    mel = torch.zeros(1, model.dims.n_mels, whisper.audio.N_FRAMES, dtype=dtype, device=model.device)
+                    model.encoder(mel)
+                    with whisper.model.disable_sdpa():
+                        model.encoder(mel)
+        self.logger.debug(f'Load time: {time.perf_counter() - t:.2f} seconds\n')
+        return model
+
+    @staticmethod
+    def _char_offsets(raw_text, raw_tokens):
+        # tokens come in the order of the text, so each token starts right after the whitespaces following the
+        # previous one, and offsets can be found in a single pass without searching the text
+        offsets = []
+        text_len = len(raw_text)
+        tok_end = 0
+        for raw_token in raw_tokens:
+            tok_start = tok_end
+            while tok_start < text_len and raw_text[tok_start].isspace():
+                tok_start += 1
+            if not raw_text.startswith(raw_token, tok_start):
+                # fall back to search, in case whisper put something in the text that's not part of any word
+                tok_start = raw_text.index(raw_token, tok_end)
+            tok_end = tok_start + len(raw_token)
+            offsets.append((tok_start, tok_end))
+        return offsets
+
     @staticmethod
     def _whisper_to_textdocument(transcript, view, source_audio_doc, lang):
         raw_text = transcript["text"]
         # make annotations
         textdoc = view.new_textdocument(text=raw_text, lang=lang)
         view.new_annotation(AnnotationTypes.Alignment, source=source_audio_doc.id, target=textdoc.id)
-        char_offset = 0
-        for segment in transcript["segments"]:
-            # skip empty segments
-            if len(segment["words"]) == 0 or len(segment["text"]) == 0:
-                continue
+        # skip empty segments
+        segments = [segment for segment in transcript["segments"]
+                    if len(segment["words"]) > 0 and len(segment["text"]) > 0]
+        words = [word for segment in segments for word in segment["words"]]
+        raw_tokens = [word["word"].strip() for word in words]
+        # convert start and end times (in seconds) of all words to (truncated) milliseconds at once
+        times = np.array([(word["start"], word["end"]) for word in words], dtype=np.float64).reshape(-1, 2)
+        times_ms = (times * 1000).astype(np.int64).tolist()
+        offsets = WhisperWrapper._char_offsets(raw_text, raw_tokens)
+        # loop invariants, hoisted out of the per-word loop
+        doc_ref = f'{view.id}:{textdoc.id}'
+        new_annotation = view.new_annotation
+        token_type, sentence_type = Uri.TOKEN, Uri.SENTENCE
+        timeframe_type, alignment_type = AnnotationTypes.TimeFrame, AnnotationTypes.Alignment
+        # words of all segments are in a single flat list, so each segment takes the next slice of it
+        seg_start = 0
+        for segment in segments:
+            seg_end = seg_start + len(segment["words"])
             token_ids = []
-            for word in segment["words"]:
-                raw_token = word["word"].strip()
-                tok_start = raw_text.index(raw_token, char_offset)
-                tok_end = tok_start + len(raw_token)
-                char_offset = tok_end
-                token = view.new_annotation(Uri.TOKEN, word=raw_token, start=tok_start, end=tok_end, document=f'{view.id}:{textdoc.id}')
+            for i in range(seg_start, seg_end):
+                raw_token, (tok_start, tok_end), (tf_start, tf_end) = raw_tokens[i], offsets[i], times_ms[i]
+                token = new_annotation(token_type, word=raw_token, start=tok_start, end=tok_end, document=doc_ref)
                 token_ids.append(token.id)
-                tf_start = int(word["start"] * 1000)
-                tf_end = int(word["end"] * 1000)
-                tf = view.new_annotation(AnnotationTypes.TimeFrame, frameType="speech", start=tf_start, end=tf_end)
-                view.new_annotation(AnnotationTypes.Alignment, source=tf.id, target=token.id)
-            view.new_annotation(Uri.SENTENCE, targets=token_ids, text=segment['text'].strip())
+                tf = new_annotation(timeframe_type, frameType="speech", start=tf_start, end=tf_end)
+                new_annotation(alignment_type, source=tf.id, target=token.id)
+            new_annotation(sentence_type, targets=token_ids, text=segment['text'].strip())
+            seg_start = seg_end
 
 
 def get_app():
@@ -4,8 +4,6 @@ The purpose of this file is to define the metadata of the app with minimal impor
 DO NOT CHANGE the name of the file
 """
 
-import re
-
 from clams.app import ClamsApp
 from clams.appmetadata import AppMetadata
 from lapps.discriminators import Uri
@@ -14,10 +12,35 @@ from mmif import DocumentTypes, AnnotationTypes
 timeunit = "milliseconds"
 default_model_size = "tiny"
 default_model_lang = ''
-whisper_version = [line.strip().rsplit('==')[-1]
-                   for line in open('requirements.txt').readlines() if re.match(r'^openai-whisper==', line)][0]
+
+def _read_whisper_version():
+    with open('requirements.txt') as requirements:
+        # drop environment markers (e.g., `; python_version >= "3.9"`) if any
+        return next(line.split('==', 1)[1].split(';', 1)[0].strip()
+                    for line in requirements if line.startswith('openai-whisper=='))
+
+whisper_version = _read_whisper_version()
 whisper_lang_list = f"https://github.com/openai/whisper/blob/{whisper_version}/whisper/tokenizer.py"
 whisper_argument_delegation_prefix = "(from whisper CLI) "
+model_lang_description = (f'Language of the model to use, accepts two- or three-letter ISO 639 language codes, '
+                          f'however Whisper only supports a subset of languages. If the language is not supported, '
+                          f'error will be raised.For the full list of supported languages, see {whisper_lang_list} . In '
+                          f'addition to the langauge code, two-letter region codes can be added to the language code, '
+                          f'e.g. "en-US" for US English. Note that the region code is only for compatibility and recording '
+                          f'purpose, and Whisper neither detects regional dialects, nor use the given one for transcription. '
+                          f'When the langauge code is not given, Whisper will run in langauge detection mode, and will use '
+                          f'first few seconds of the audio to detect the language.')
+# parameters delegated to the underlying whisper interface, copied from whisper's transcribe.py (cli())
+whisper_delegated_parameters = [
+    dict(name="task", type='string', default="transcribe", choices=["transcribe", "translate"], 
+         description=whisper_argument_delegation_prefix + "whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')"),
+    dict(name="initialPrompt", type='string', default='',
+         description=whisper_argument_delegation_prefix + "optional text to provide as a prompt for the first window."),
+    dict(name="conditionOnPreviousText", type='boolean', default=True, 
+         description=whisper_argument_delegation_prefix + "if True, provide the previous output of the model as a prompt for the next window; disabling may make the text inconsistent across windows, but the model becomes less prone to getting stuck in a failure loop"),
+    dict(name="noSpeechThreshold", type='number', default=0.6, 
+         description=whisper_argument_delegation_prefix + "if the probability of the <|nospeech|> token is higher than this value AND the decoding has failed due to `logprob_threshold`, consider the segment as silence"),
+]
 
 # DO NOT CHANGE the function name
 def appmetadata() -> AppMetadata:
@@ -50,26 +73,44 @@ def appmetadata() -> AppMetadata:
 
     metadata.add_parameter(
         name='modelLang', 
-        description=f'Language of the model to use, accepts two- or three-letter ISO 639 language codes, '
-                    f'however Whisper only supports a subset of languages. If the language is not supported, '
-                    f'error will be raised.For the full list of supported languages, see {whisper_lang_list} . In '
-                    f'addition to the langauge code, two-letter region codes can be added to the language code, '
-                    f'e.g. "en-US" for US English. Note that the region code is only for compatibility and recording '
-                    f'purpose, and Whisper neither detects regional dialects, nor use the given one for transcription. '
-                    f'When the langauge code is not given, Whisper will run in langauge detection mode, and will use '
-                    f'first few seconds of the audio to detect the language.',
+        description=model_lang_description,
         type='string',
         default=default_model_lang
     )
-    # and some delegated parameters from the underlying whisper interface, copied from whisper's transcribe.py (cli())
-    metadata.add_parameter(name="task", type='string', default="transcribe", choices=["transcribe", "translate"], 
-                           description=whisper_argument_delegation_prefix + "whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
-    metadata.add_parameter(name="initialPrompt", type='string', default='',
-                           description=whisper_argument_delegation_prefix + "optional text to provide as a prompt for the first window.")
-    metadata.add_parameter(name="conditionOnPreviousText", type='boolean', default=True, 
-                           description=whisper_argument_delegation_prefix + "if True, provide the previous output of the model as a prompt for the next window; disabling may make the text inconsistent across windows, but the model becomes less prone to getting stuck in a failure loop")
-    metadata.add_parameter(name="noSpeechThreshold", type='number', default=0.6, 
-                           description=whisper_argument_delegation_prefix + "if the probability of the <|nospeech|> token is higher than this value AND the decoding has failed due to `logprob_threshold`, consider the segment as silence")
+
+    metadata.add_parameter(
+        name='throughputMode',
+        description='When true, decode with greedy search (instead of beam search with 5 beams) only at temperature 0 '
+                    '(no fallback to higher temperatures when decoding fails), and without conditioning each window on '
+                    'the previously transcribed text. This makes transcription several times faster, at the cost of '
+                    'some accuracy. This overrides `conditionOnPreviousText`.',
+        type='boolean',
+        default=False
+    )
+
+    metadata.add_parameter(
+        name='vadFilter',
+        description='When true, run Silero voice activity detection (VAD) on the audio first, and only transcribe '
+                    'the regions where speech is detected, skipping long silences and non-speech (e.g., music) '
+                    'regions. Timestamps are still relative to the whole audio. Speech missed by the VAD will not be '
+                    'transcribed.',
+        type='boolean',
+        default=False
+    )
+
+    metadata.add_parameter(
+        name='computeType',
+        description='Numeric precision to run the model with. `auto` uses `float16` when a CUDA GPU is available, '
+                    'and otherwise `int8` (dynamic quantization of linear layers, CPU only, falls back to `float32` '
+                    'when the torch installation has no quantized kernels). `int8` always runs on CPU, even when a GPU '
+                    'is available. `float16` on CPU is not supported by whisper and falls back to `float32`.',
+        type='string',
+        choices=['auto', 'float32', 'float16', 'int8'],
+        default='auto'
+    )
+    # and some delegated parameters from the underlying whisper interface
+    for param in whisper_delegated_parameters:
+        metadata.add_parameter(**param)
 
     return metadata
 